@@ -1,25 +1,43 @@
 #!/usr/bin/env python3
-import subprocess
-import threading
-import base64
+import asyncio
+import glob
+import gzip
+import hashlib
 import os
+import shutil
+import tempfile
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+import img2pdf
+import socketio
+import uvicorn
 from dotenv import load_dotenv
-from flask import Flask, render_template_string
-from flask_socketio import SocketIO
+from PIL import Image
 
 # pylint: disable=invalid-name,missing-function-docstring,global-statement,broad-exception-caught
 
 load_dotenv()
 
-app = Flask(__name__)
-app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
-socketio = SocketIO(app, async_mode="threading")
+sio = socketio.AsyncServer(async_mode="asgi", http_compression=True, compression_threshold=1024)
 
 # URL to open in a new tab after the process exits
 TARGET_URL = os.getenv("END_URL")
 
+SCAN_CMD = (
+    "scanimage",
+    "--batch=page-%03d.png",
+    "--format=png",
+    "--resolution", "300",
+    "-x", "210",
+    "-y", "297",
+    "-d", "airscan:e0:uri",
+    "--source", "ADF",
+)
+PRINT_CMD = ("lp", "-d", "caos_printer", "-")
+
 index_html = r"""
 <!doctype html>
 <html lang="en">
@@ -176,8 +194,15 @@ index_html = r"""
       sendFileToServer(file);
     });
 
+    // Stream chunks arrive as binary frames, status messages as objects
+    const consoleDecoder = new TextDecoder('utf-8', {fatal: false});
+
     socket.on('console_output', (msg) => {
-      appendToConsole(msg.data);
+      if (msg instanceof ArrayBuffer) {
+        appendToConsole(consoleDecoder.decode(msg, {stream: true}));
+      } else {
+        appendToConsole(msg.data);
+      }
     });
 
     socket.on('console_clear', () => {
@@ -239,165 +264,423 @@ index_html = r"""
 
     // ---------- Upload helper (BINARY SAFE) ----------
 
-    function sendFileToServer(file) {
-      const reader = new FileReader();
-      reader.onload = () => {
-        const arrayBuffer = reader.result;
-        const bytes = new Uint8Array(arrayBuffer);
-
-        // Convert to base64
-        let binary = "";
-        for (let i = 0; i < bytes.length; i++) {
-          binary += String.fromCharCode(bytes[i]);
-        }
-        const base64data = btoa(binary);
-
-        socket.emit('print', {
-          content_b64: base64data
-        });
-      };
-      // Binary-safe read:
-      reader.readAsArrayBuffer(file);
+    // Slice size for chunked uploads; keeps server memory bounded
+    const UPLOAD_CHUNK = 20 * 1024 * 1024;
+
+    async function sendFileToServer(file) {
+      // Wait for the server to ack the job: the stdin sink only exists once
+      // the process has spawned, so chunks sent earlier would be dropped.
+      // The ack is a job token (or null if rejected) that every chunk must
+      // carry, so a rejected upload can't feed another job's stdin.
+      const job = await socket.emitWithAck('print');
+      if (!job) return;
+      for (let offset = 0; offset < file.size; offset += UPLOAD_CHUNK) {
+        // socket.io serializes an ArrayBuffer as a binary frame, so the
+        // server receives the raw bytes without any base64 round-trip.
+        // Awaiting the ack keeps exactly one chunk in flight, so neither
+        // side buffers more than a chunk while the printer catches up.
+        const chunk = await file.slice(offset, offset + UPLOAD_CHUNK).arrayBuffer();
+        const ok = await socket.emitWithAck('print_chunk', {job: job, chunk: chunk});
+        if (!ok) return;
+      }
+      socket.emit('print_end', {job: job});
     }
   </script>
 </body>
 </html>
 """
 
-process_lock = threading.Lock()
-current_process = None
+class ConsoleQueue:
+    """Bounded queue for per-client console traffic.
+
+    Items are raw bytes (binary console_output frames) or (event, payload)
+    tuples for status/control events, kept in one FIFO so a client never
+    sees e.g. the exit message before its remaining output. If emitting
+    can't keep up (e.g. a client went away mid-scan), new byte chunks are
+    merged into the same client's newest bytes entry once the queue is
+    full, so the entry count stays bounded without losing any output even
+    when several clients are active at once.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self._items = deque()
+        self._maxsize = maxsize
+        self._ready = asyncio.Event()
+
+    def put(self, sid: str, item):
+        if isinstance(item, bytes) and len(self._items) >= self._maxsize:
+            for i in range(len(self._items) - 1, -1, -1):
+                s, queued = self._items[i]
+                if s == sid and isinstance(queued, bytes):
+                    self._items[i] = (sid, queued + item)
+                    self._ready.set()
+                    return
+            # No bytes entry for this sid yet: append one so its later
+            # chunks have something to merge into
+        self._items.append((sid, item))
+        self._ready.set()
+
+    async def get(self):
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._items.popleft()
+
+
+console_queue = ConsoleQueue()
+_console_worker = None
+
+
+async def _drain_console_queue():
+    while True:
+        sid, item = await console_queue.get()
+        if isinstance(item, bytes):
+            await sio.emit("console_output", item, to=sid)
+        else:
+            event, payload = item
+            await sio.emit(event, payload, to=sid)
+
+
+def _ensure_console_worker():
+    global _console_worker
+    if _console_worker is None:
+        _console_worker = sio.start_background_task(_drain_console_queue)
+
+
+def queue_console_output(sid: str, data: bytes):
+    """Enqueue a binary console frame; a single worker task does the emits
+    so pipe readers never block on socket backpressure."""
+    _ensure_console_worker()
+    console_queue.put(sid, data)
+
+
+def queue_console_event(sid: str, event: str, payload):
+    """Enqueue a status/control event behind any pending console frames for
+    this client, so it is delivered in order with the stream."""
+    _ensure_console_worker()
+    console_queue.put(sid, (event, payload))
+
+
+process_lock = asyncio.Lock()
+# Placeholder claiming a process slot while the subprocess is spawning
+_SPAWNING = object()
+# Per-client process slots: sid -> _SPAWNING or asyncio.subprocess.Process
+procs: dict = {}
+# Per-client (job token, stdin) of the process being fed by a chunked upload
+sinks: dict[str, tuple[str, asyncio.StreamWriter]] = {}
+
+_index_body = index_html.encode("utf-8")
+_index_gzip = gzip.compress(_index_body, 9)
+_index_etag = b'"' + hashlib.blake2b(_index_body, digest_size=16).hexdigest().encode("ascii") + b'"'
+
+
+async def index(scope, receive, send):
+    """Minimal ASGI app serving the single page; everything else is 404."""
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] != "/":
+        await send({
+            "type": "http.response.start",
+            "status": 404,
+            "headers": [(b"content-type", b"text/html; charset=utf-8")],
+        })
+        await send({"type": "http.response.body", "body": b"Not Found"})
+        return
+
+    headers = [
+        (b"content-type", b"text/html; charset=utf-8"),
+        (b"etag", _index_etag),
+        (b"cache-control", b"public, max-age=3600"),
+        (b"vary", b"accept-encoding"),
+    ]
+
+    if_none_match = next((v for k, v in scope["headers"] if k == b"if-none-match"), None)
+    if if_none_match is not None and _index_etag in if_none_match:
+        await send({"type": "http.response.start", "status": 304, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    body = _index_body
+    accept_encoding = next((v for k, v in scope["headers"] if k == b"accept-encoding"), b"")
+    if b"gzip" in accept_encoding:
+        headers.append((b"content-encoding", b"gzip"))
+        body = _index_gzip
 
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
 
-@app.route("/")
-def index():
-    return render_template_string(index_html)
+
+app = socketio.ASGIApp(sio, other_asgi_app=index)
 
 
 def delayed_remove(path: str, delay: float = 10.0):
-    def worker():
-        time.sleep(delay)
+    def remove():
         try:
             os.remove(path)
         except Exception as e:
             print(f"Error removing {path}: {e}")
 
-    t = threading.Thread(target=worker, daemon=True)
-    t.start()
+    # A timer callback on the loop is cheaper than parking a whole
+    # task/thread just to sleep until the removal is due
+    asyncio.get_running_loop().call_later(delay, remove)
 
 
-def start_process_and_stream(
-    command: list[str], stdin_data: bytes | None = None, welcome_msg: str | None = None, end_file: str | None = None,
+async def start_process_and_stream(
+    sid: str,
+    command: list[str],
+    feed_stdin: bool = False,
+    welcome_msg: str | None = None,
+    end_file: str | None = None,
+    post_process=None,
+    cwd: str | None = None,
 ):
-    """Helper: start process, optionally feed stdin, stream stdout/stderr, then open URL."""
-    global current_process
-
-    with process_lock:
-        if current_process is not None and current_process.poll() is None:
-            socketio.emit(
-                "console_output",
-                {"data": "[process already running – wait for it to finish]\n"},
-            )
-            return
+    """Helper: start process, stream stdout/stderr, then open URL.
+
+    State is keyed by the client's sid, so each client runs its own process
+    and only sees its own console. With feed_stdin=True the process stdin is
+    published in sinks so the chunked-upload handlers can stream into it as
+    chunks arrive. post_process is an optional coroutine function called
+    with (sid, retcode) after every process exit — success or not, so it
+    can clean up job files — before end_file is checked.
+
+    Returns a truthy value once the process is running — the job token for
+    feed_stdin jobs, True otherwise — or False if the slot was busy or the
+    spawn failed; handlers can return this as the event ack.
+    """
+    # Only the check-and-claim of the process slot runs under the lock;
+    # spawning (which can block on fork/exec) and emits happen outside it.
+    async with process_lock:
+        slot = procs.get(sid)
+        if slot is not None and (slot is _SPAWNING or slot.returncode is None):
+            busy = True
+        else:
+            busy = False
+            procs[sid] = _SPAWNING
+
+    if busy:
+        queue_console_event(
+            sid, "console_output",
+            {"data": "[process already running – wait for it to finish]\n"},
+        )
+        return False
 
-        socketio.emit("console_clear")
+    queue_console_event(sid, "console_clear", None)
 
-        if welcome_msg:
-            socketio.emit(
-                "console_output",
-                {"data": f"[{welcome_msg}]\n"},
-            )
+    if welcome_msg:
+        queue_console_event(
+            sid, "console_output",
+            {"data": f"[{welcome_msg}]\n"},
+        )
 
-        try:
-            current_process = subprocess.Popen(
-                command,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=False,
-                bufsize=0,
-            )
-        except Exception as e:
-            socketio.emit(
-                "console_output",
-                {"data": f"Failed to start command: {e}\n"},
-            )
-            current_process = None
-            return
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            cwd=cwd,
+        )
+    except Exception as e:
+        queue_console_event(
+            sid, "console_output",
+            {"data": f"Failed to start command: {e}\n"},
+        )
+        async with process_lock:
+            procs.pop(sid, None)
+        return False
 
-    def stream_output(proc: subprocess.Popen, stdin: bytes | None, end_file: str | None = None):
-        try:
-            # Send data to stdin if provided
-            if stdin is not None and proc.stdin:
-                try:
-                    proc.stdin.write(stdin)
-                    proc.stdin.close()
-                except Exception as e:
-                    socketio.emit(
-                        "console_output",
-                        {"data": f"[error writing to stdin: {e}]\n"},
-                    )
+    job = uuid.uuid4().hex if feed_stdin else None
+    async with process_lock:
+        procs[sid] = proc
+        if feed_stdin:
+            sinks[sid] = (job, proc.stdin)
 
-            # Stream stdout+stderr as chunks, decoding for display
+    async def stream_output(proc: asyncio.subprocess.Process, end_file: str | None = None):
+        try:
+            # Stream stdout+stderr as raw binary frames; the browser decodes
+            # them with a streaming TextDecoder, so no JSON escaping or
+            # server-side decode pass is needed and codepoints split across
+            # flushes are still handled.
+            # Coalesce small pipe reads so a verbose process doesn't turn
+            # into thousands of tiny websocket frames: flush once the
+            # buffer is large enough or enough time has passed.
             if proc.stdout:
+                buf = bytearray()
+                last_flush = time.monotonic()
                 while True:
-                    chunk = proc.stdout.read(4096)
+                    try:
+                        chunk = await asyncio.wait_for(proc.stdout.read(1 << 16), timeout=0.05)
+                    except asyncio.TimeoutError:
+                        # Pipe went quiet: flush whatever has accumulated
+                        # instead of sitting on it until the next read
+                        if buf:
+                            queue_console_output(sid, bytes(buf))
+                            buf.clear()
+                            last_flush = time.monotonic()
+                        continue
+                    if chunk:
+                        buf += chunk
+                        now = time.monotonic()
+                        if len(buf) < 64 * 1024 and now - last_flush < 0.05:
+                            continue
+                    elif not buf:
+                        break
+                    queue_console_output(sid, bytes(buf))
+                    buf.clear()
+                    last_flush = time.monotonic()
                     if not chunk:
                         break
-                    text = chunk.decode("utf-8", errors="replace")
-                    socketio.emit("console_output", {"data": text})
 
-            retcode = proc.wait()
-            socketio.emit(
-                "console_output",
+            retcode = await proc.wait()
+            queue_console_event(
+                sid, "console_output",
                 {"data": f"\n[process exited with code {retcode}]\n"},
             )
 
+            if post_process:
+                try:
+                    await post_process(sid, retcode)
+                except Exception as e:
+                    queue_console_event(
+                        sid, "console_output",
+                        {"data": f"[post-processing failed: {e}]\n"},
+                    )
+
             if end_file and os.path.exists(end_file):
-                socketio.emit("open_url", {"url": TARGET_URL + end_file})
+                queue_console_event(sid, "open_url", {"url": TARGET_URL + end_file})
                 delayed_remove(end_file, 30)
 
         finally:
-            global current_process
-            with process_lock:
-                current_process = None
-
-    t = threading.Thread(target=stream_output, args=(current_process, stdin_data, end_file))
-    t.daemon = True
-    t.start()
-
+            # Only clear this job's own state: the slot is considered free
+            # as soon as the process exits, so another job may already have
+            # claimed it while post_process was still running
+            async with process_lock:
+                if procs.get(sid) is proc:
+                    del procs[sid]
+                entry = sinks.get(sid)
+                if entry is not None and entry[0] == job:
+                    del sinks[sid]
+
+    sio.start_background_task(stream_output, proc, end_file)
+    return job if feed_stdin else True
+
+
+async def convert_scan_pages(sid: str, retcode: int, workdir: str, out_pdf: str):
+    """Turn the page PNGs in workdir into out_pdf in-process.
+
+    JPEG encoding runs across a thread pool (Pillow releases the GIL) and
+    img2pdf assembles the PDF directly, instead of forking one convert per
+    page and an img2pdf process. Runs after every scan exit so the per-job
+    directory is always cleaned up; conversion only happens on a clean exit.
+    """
+    try:
+        if retcode != 0:
+            return
 
-@socketio.on("scan")
-def handle_scan():
-    command = [
-        "bash",
-        "-c",
-        "unbuffer scanimage --batch=page-%03d.png --format=png --resolution 300 -x 210 -y 297 -d 'airscan:e0:uri' --source ADF && ls page-*.png | parallel convert -quality 80 {} {}.jpg && img2pdf page-*.jpg -o scan.pdf && rm page-*",
-    ]
-    start_process_and_stream(stdin_data=None, command=command, welcome_msg="Beginning scan", end_file="scan.pdf")
+        pages = sorted(glob.glob(os.path.join(workdir, "page-*.png")))
+        if not pages:
+            queue_console_event(sid, "console_output", {"data": "[no pages scanned]\n"})
+            return
 
+        loop = asyncio.get_running_loop()
+
+        def to_jpeg(path: str) -> str:
+            with Image.open(path) as img:
+                img.convert("RGB").save(path + ".jpg", quality=80)
+            return path + ".jpg"
+
+        queue_console_event(sid, "console_output", {"data": f"[converting {len(pages)} pages]\n"})
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            jpegs = list(await asyncio.gather(*(loop.run_in_executor(pool, to_jpeg, p) for p in pages)))
+
+        def write_pdf():
+            with open(out_pdf, "wb") as f:
+                img2pdf.convert(jpegs, outputstream=f)
+
+        await loop.run_in_executor(None, write_pdf)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@sio.on("scan")
+async def handle_scan(sid):
+    # Each scan runs in its own directory with a unique PDF name, so
+    # concurrent jobs can't glob, clobber, or open_url each other's files
+    workdir = tempfile.mkdtemp(prefix="scan-")
+    end_file = f"scan-{uuid.uuid4().hex[:8]}.pdf"
+
+    async def post_process(sid, retcode):
+        await convert_scan_pages(sid, retcode, workdir, end_file)
+
+    started = await start_process_and_stream(
+        sid, command=list(SCAN_CMD), welcome_msg="Beginning scan", end_file=end_file,
+        post_process=post_process, cwd=workdir,
+    )
+    if not started:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@sio.on("print")
+async def handle_print(sid):
+    # The return value is delivered to the client as the ack; it only starts
+    # streaming chunks once the job is accepted and the sink exists
+    return await start_process_and_stream(
+        sid, command=list(PRINT_CMD), feed_stdin=True, welcome_msg="Beginning print",
+    )
+
+
+@sio.on("print_chunk")
+async def handle_print_chunk(sid, message):
+    # socket.io delivers the ArrayBuffer sent by the browser as bytes.
+    # Chunks carrying a stale token (e.g. from a rejected job) are dropped
+    # instead of being spliced into whatever process is currently running.
+    # The ack is only sent after drain(), so the client keeps a single
+    # chunk in flight and a slow printer can't pile chunks up in memory.
+    entry = sinks.get(sid)
+    if entry is None or entry[0] != message.get("job"):
+        return False
+    sink = entry[1]
+    try:
+        sink.write(bytes(message.get("chunk", b"")))
+        await sink.drain()
+    except Exception as e:
+        queue_console_event(
+            sid, "console_output",
+            {"data": f"[error writing to stdin: {e}]\n"},
+        )
+        return False
+    return True
 
-@socketio.on("print")
-def handle_print(message):
-    command = [
-        "lp",
-        "-d",
-        "caos_printer",
-        "-"
-    ]
-    content_b64 = message.get("content_b64", "")
 
+@sio.on("print_end")
+async def handle_print_end(sid, message):
+    async with process_lock:
+        entry = sinks.get(sid)
+        if entry is None or entry[0] != message.get("job"):
+            return
+        sinks.pop(sid)
     try:
-        content = base64.b64decode(content_b64)
+        entry[1].close()
     except Exception as e:
-        socketio.emit(
-            "console_output",
-            {"data": f"[failed to decode uploaded file: {e}]\n"},
+        queue_console_event(
+            sid, "console_output",
+            {"data": f"[error closing stdin: {e}]\n"},
         )
-        return
 
-    start_process_and_stream(stdin_data=content, command=command, welcome_msg="Beginning print")
+
+@sio.on("disconnect")
+async def handle_disconnect(sid):
+    # Close a half-fed upload so its process can finish and clean itself up
+    async with process_lock:
+        entry = sinks.pop(sid, None)
+    if entry is not None:
+        try:
+            entry[1].close()
+        except Exception:
+            pass
 
 
 if __name__ == "__main__":
-    # pip install flask flask-socketio
-    socketio.run(app, host=os.getenv("HOST"), port=int(os.getenv("PORT")), debug=False, allow_unsafe_werkzeug=True)
+    # pip install python-socketio uvicorn pillow img2pdf
+    uvicorn.run(app, host=os.getenv("HOST"), port=int(os.getenv("PORT")))